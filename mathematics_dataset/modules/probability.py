@@ -30,7 +30,6 @@ from mathematics_dataset.util import combinatorics
 from mathematics_dataset.util import composition
 from mathematics_dataset.util import display
 from mathematics_dataset.util import probability
-import numpy as np
 from six.moves import range
 from six.moves import zip
 
@@ -214,7 +213,7 @@ def _sample_without_replacement_probability_question(
       size = len(event_in_space.all_sequences())
     else:
       assert isinstance(event_in_space, probability.FiniteProductEvent)
-      size = np.prod([len(event.values) for event in event_in_space.events])
+      size = event_in_space.cardinality
     return size > int(2e5)
 
   allow_trivial_prob = random.random() < _MAX_FRAC_TRIVIAL_PROB
@@ -36,13 +36,103 @@ from __future__ import print_function
 
 import abc
 import itertools
+import math
 
 # Dependency imports
+import numpy as np
 import six
+from six.moves import range
 from six.moves import zip
 import sympy
 
 
+# Number of sequences converted from label ids to tuples of values at a time.
+_SEQUENCE_CHUNK_SIZE = 4096
+
+# Memoized factorials; the arguments seen in practice are small and heavily
+# repeated.
+_FACT_CACHE = {}
+
+
+def _fact(n):
+  """Returns `n!` as a Python integer."""
+  result = _FACT_CACHE.get(n)
+  if result is None:
+    result = _FACT_CACHE.setdefault(n, math.factorial(n))
+  return result
+
+
+def _multinomial(counts):
+  """Returns multinomial coefficient `sum(counts)! / prod(c! for c in counts)`.
+
+  This uses plain integer arithmetic (rather than sympy) as it is on the hot
+  path of `FiniteProductSpace.probability`.
+
+  Args:
+    counts: Iterable of non-negative integers.
+
+  Returns:
+    Python integer.
+  """
+  counts = list(counts)
+  denominator = 1
+  for count in counts:
+    denominator *= _fact(count)
+  return _fact(sum(counts)) // denominator
+
+
+def _multiset_permutations(counts):
+  """Returns all distinct orderings of a multiset, as an array of label ids.
+
+  Generated via (bottom-up) dynamic programming over the lattice of counts
+  tuples. `itertools.product` visits these in lexicographic order, so the
+  entries for each `counts - e_i` are available before `counts`; each entry is
+  then built (as a block per label id) by prepending that label id to them.
+
+  Args:
+    counts: List of non-negative integers; `counts[i]` is the number of times
+        label id `i` occurs in each sequence.
+
+  Returns:
+    `int16` array of shape `(num_sequences, sum(counts))`, with rows in
+    lexicographic order.
+  """
+  target = tuple(counts)
+  cache = {}  # dict mapping tuple -> array of sequences
+  for counts in itertools.product(*[range(count + 1) for count in target]):
+    if not any(counts):
+      cache[counts] = np.zeros((1, 0), dtype=np.int16)
+      continue
+    blocks = []
+    for i, count in enumerate(counts):
+      if count == 0:
+        continue
+      extensions = cache[counts[:i] + (count - 1,) + counts[i + 1:]]
+      block = np.empty((len(extensions), extensions.shape[1] + 1),
+                       dtype=np.int16)
+      block[:, 0] = i
+      block[:, 1:] = extensions
+      blocks.append(block)
+    cache[counts] = np.concatenate(blocks)
+  return cache[target]
+
+
+def _cartesian_product(arrays):
+  """Returns cartesian product of 1-d arrays, as array with a row per element.
+
+  Args:
+    arrays: List of 1-d `int64` arrays.
+
+  Returns:
+    `int64` array of shape `(prod(len(array) for array in arrays),
+    len(arrays))`, with rows in the same order as `itertools.product(*arrays)`.
+  """
+  if not arrays:
+    return np.zeros((1, 0), dtype=np.int64)
+  grids = np.meshgrid(*arrays, indexing='ij')
+  return np.stack(grids, axis=-1).reshape(-1, len(arrays))
+
+
 @six.add_metaclass(abc.ABCMeta)
 class Event(object):
   """Represents an event in a measure space."""
@@ -74,12 +164,32 @@ class DiscreteEvent(Event):
   """Set of discrete values."""
 
   def __init__(self, values):
-    self._values = values
+    """Initializes a `DiscreteEvent`.
+
+    Args:
+      values: Iterable of (hashable) values; stored as a `frozenset`, so that
+          events can be hashed and used as cache keys.
+    """
+    self._values = (
+        values if isinstance(values, frozenset) else frozenset(values))
+    self._hash = hash(self._values)
 
   @property
   def values(self):
     return self._values
 
+  def __hash__(self):
+    return self._hash
+
+  def __eq__(self, other):
+    if not isinstance(other, DiscreteEvent):
+      return NotImplemented
+    return self._values == other.values
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
 
 class FiniteProductEvent(Event):
   """Event consisting of cartesian product of events."""
@@ -92,11 +202,28 @@ class FiniteProductEvent(Event):
           these.
     """
     self._events = events
+    self._cardinality = None
 
   @property
   def events(self):
     return self._events
 
+  def _values_list(self):
+    """Returns list of component values; raises `ValueError` if not discrete."""
+    if not all(isinstance(event, DiscreteEvent) for event in self._events):
+      raise ValueError('Not all component events are DiscreteEvents')
+    return [event.values for event in self._events]
+
+  @property
+  def cardinality(self):
+    """Number of sequences in this event (without generating them)."""
+    if self._cardinality is None:
+      cardinality = 1
+      for values in self._values_list():
+        cardinality *= len(values)
+      self._cardinality = cardinality
+    return self._cardinality
+
   def all_sequences(self):
     """Returns iterator of sequences by selecting a single event in each coord.
 
@@ -108,10 +235,7 @@ class FiniteProductEvent(Event):
     Raises:
       ValueError: If one of the component events is not a `DiscreteEvent`.
     """
-    if not all(isinstance(event, DiscreteEvent) for event in self._events):
-      raise ValueError('Not all component events are DiscreteEvents')
-    values_list = [event.values for event in self._events]
-    return itertools.product(*values_list)
+    return itertools.product(*self._values_list())
 
 
 class CountLevelSetEvent(Event):
@@ -121,50 +245,54 @@ class CountLevelSetEvent(Event):
     """Initializes `CountLevelSetEvent`.
 
     E.g., to construct the event of getting two red balls and one green ball,
-    pass `counts = {red: 2, green: 1}`. (Then `all_sequences()` would return
-    `[(red, red, green), (red, green, red), (green, red, red)]`.
+    pass `counts = {red: 2, green: 1}`. (Then `all_sequences()` would generate
+    `(red, red, green), (red, green, red), (green, red, red)`.)
 
     Args:
       counts: Dictionary mapping values to the number of times they occur in a
           sequence.
     """
     self._counts = counts
-    self._all_sequences = None
+    self._label_table = tuple(counts.keys())
+    self._sequence_ids = None
 
   @property
   def counts(self):
     return self._counts
 
+  @property
+  def labels(self):
+    """Tuple of values, indexed by the entries of `sequence_ids()`."""
+    return self._label_table
+
+  def sequence_ids(self):
+    """Returns all sequences, as an integer array of indices into `labels`.
+
+    Returns:
+      Array of shape `(num_sequences, sum(counts.values()))`, with rows in
+      lexicographic order.
+    """
+    if self._sequence_ids is None:
+      self._sequence_ids = _multiset_permutations(list(self._counts.values()))
+    return self._sequence_ids
+
   def all_sequences(self):
-    """Returns all sequences generated by this level set."""
-    if self._all_sequences is None:
-      # Generate via dynamic programming.
-      cache = {}  # dict mapping tuple -> list of tuples
-      labels = list(self._counts.keys())
-
-      def generate(counts):
-        """Returns list of tuples for given `counts` of labels."""
-        if sum(counts) == 0:
-          return [()]
-        counts = tuple(counts)
-        if counts in cache:
-          return cache[counts]
-        generated = []
-        for i, count in enumerate(counts):
-          if count == 0:
-            continue
-          counts_minus = list(counts)
-          counts_minus[i] -= 1
-          counts_minus = tuple(counts_minus)
-          extensions = generate(counts_minus)
-          generated += [tuple([labels[i]] + list(extension))
-                        for extension in extensions]
-        cache[counts] = generated
-        return generated
-
-      self._all_sequences = generate(list(self._counts.values()))
-
-    return self._all_sequences
+    """Returns iterator over all sequences generated by this level set.
+
+    Sequences are stored compactly as label ids (see `sequence_ids`), and only
+    converted to tuples of values as they are iterated over.
+
+    Yields:
+      Tuples of values.
+    """
+    sequence_ids = self.sequence_ids()
+    label_table = np.empty(len(self._label_table), dtype=object)
+    for i, label in enumerate(self._label_table):
+      label_table[i] = label
+    for start in range(0, len(sequence_ids), _SEQUENCE_CHUNK_SIZE):
+      chunk = label_table[sequence_ids[start:start + _SEQUENCE_CHUNK_SIZE]]
+      for sequence in chunk.tolist():
+        yield tuple(sequence)
 
 
 class SequenceEvent(Event):
@@ -197,11 +325,16 @@ class DiscreteProbabilitySpace(ProbabilitySpace):
           that value. This will be normalized.
     """
     self._weights = normalize_weights(weights)
+    self._weights_keys = frozenset(self._weights)
+    self._prob_cache = {}  # dict mapping frozenset of values -> probability
 
   def probability(self, event):
     if isinstance(event, DiscreteEvent):
-      return sum(self._weights[value]
-                 for value in event.values if value in self._weights)
+      key = event.values
+      if key not in self._prob_cache:
+        self._prob_cache[key] = sum(
+            self._weights[value] for value in key & self._weights_keys)
+      return self._prob_cache[key]
     else:
       raise ValueError('Unhandled event type {}'.format(type(event)))
 
@@ -221,33 +354,70 @@ class FiniteProductSpace(ProbabilitySpace):
       spaces: List of `ProbabilitySpace`.
     """
     self._spaces = spaces
+    self._all_spaces_equal = all(
+        self._spaces[0] == space for space in self._spaces[1:])
+    # Memoized sub-space probabilities, keyed on `(id(space), event)`; and
+    # multinomial coefficients, keyed on the sorted counts.
+    self._sub_prob_cache = {}
+    self._coeff_cache = {}
+
+  def _sub_probability(self, space, event):
+    """Returns `space.probability(event)`, memoized for `DiscreteEvent`s."""
+    if not isinstance(event, DiscreteEvent):
+      return space.probability(event)
+    key = (id(space), event)
+    if key not in self._sub_prob_cache:
+      self._sub_prob_cache[key] = space.probability(event)
+    return self._sub_prob_cache[key]
 
   def all_spaces_equal(self):
-    return all([self._spaces[0] == space for space in self._spaces])
+    return self._all_spaces_equal
 
   def probability(self, event):
     # Specializations for optimization.
     if isinstance(event, FiniteProductEvent):
       assert len(self._spaces) == len(event.events)
       return sympy.prod([
-          space.probability(event_slice)
+          self._sub_probability(space, event_slice)
           for space, event_slice in zip(self._spaces, event.events)])
 
     if isinstance(event, CountLevelSetEvent) and self.all_spaces_equal():
       space = self._spaces[0]
       counts = event.counts
-      probabilities = {
-          value: space.probability(DiscreteEvent({value}))
-          for value in six.iterkeys(counts)
-      }
+      if isinstance(space, DiscreteProbabilitySpace):
+        # Read per-value probabilities directly, rather than via events.
+        weights = space.weights
+        probabilities = {
+            value: weights.get(value, sympy.Integer(0))
+            for value in six.iterkeys(counts)
+        }
+      else:
+        probabilities = {
+            value: self._sub_probability(space, DiscreteEvent({value}))
+            for value in six.iterkeys(counts)
+        }
 
       num_events = sum(six.itervalues(counts))
       assert num_events == len(self._spaces)
       # Multinomial coefficient:
-      coeff = (
-          sympy.factorial(num_events) / sympy.prod(
-              [sympy.factorial(i) for i in six.itervalues(counts)]))
-      return coeff * sympy.prod([
+      coeff_key = tuple(sorted(six.itervalues(counts)))
+      coeff = self._coeff_cache.get(coeff_key)
+      if coeff is None:
+        coeff = _multinomial(six.itervalues(counts))
+        self._coeff_cache[coeff_key] = coeff
+
+      if all(isinstance(p, sympy.Rational)
+             for p in six.itervalues(probabilities)):
+        # Accumulate numerator and denominator as integers, and construct a
+        # single `sympy.Rational` at the end.
+        numerator = coeff
+        denominator = 1
+        for value, count in six.iteritems(counts):
+          numerator *= probabilities[value].p**count
+          denominator *= probabilities[value].q**count
+        return sympy.Rational(numerator, denominator)
+
+      return sympy.Integer(coeff) * sympy.prod([
           pow(probabilities[value], counts[value])
           for value in six.iterkeys(counts)
       ])
@@ -279,6 +449,19 @@ class SampleWithoutReplacementSpace(ProbabilitySpace):
     self._weights = normalize_weights(weights)
     self._n_samples = n_samples
 
+    # Integer representation of the weights for vectorized computation: value
+    # with id `i` has probability `self._numerators[i] / self._denominator`.
+    # Values outside of the space are mapped to a final id with zero weight.
+    self._denominator = int(sympy.lcm(
+        [sympy.denom(weight) for weight in six.itervalues(self._weights)]))
+    self._value_ids = {}
+    numerators = []
+    for value, weight in six.iteritems(self._weights):
+      self._value_ids[value] = len(numerators)
+      numerators.append(int(weight * self._denominator))
+    numerators.append(0)
+    self._numerators = np.array(numerators, dtype=np.int64)
+
   @property
   def n_samples(self):
     """Number of samples to draw."""
@@ -290,21 +473,66 @@ class SampleWithoutReplacementSpace(ProbabilitySpace):
     except AttributeError:
       raise ValueError('Unhandled event type {}'.format(type(event)))
 
-    probability_sum = 0
-    for sequence in all_sequences:
-      if len(sequence) != len(set(sequence)):
-        continue  # not all unique, so not "without replacement".
-      p_sequence = 1
-      removed_prob = 0
-      for i in sequence:
-        p = self._weights[i] if i in self._weights else 0
-        if p == 0:
-          p_sequence = 0
-          break
-        p_sequence *= p / (1 - removed_prob)
-        removed_prob += p
-      probability_sum += p_sequence
-    return probability_sum
+    missing_id = len(self._value_ids)
+    if isinstance(event, FiniteProductEvent):
+      # Map each component's values to ids, and take the product of these
+      # (rather than iterating over `all_sequences`).
+      ids = _cartesian_product([
+          np.array([self._value_ids.get(value, missing_id)
+                    for value in sub_event.values], dtype=np.int64)
+          for sub_event in event.events])
+    elif isinstance(event, CountLevelSetEvent):
+      # Translate the label table, rather than each sequence, to value ids.
+      label_ids = np.array(
+          [self._value_ids.get(label, missing_id) for label in event.labels],
+          dtype=np.int64)
+      ids = label_ids[event.sequence_ids()]
+    else:
+      rows = []
+      for sequence in all_sequences:
+        if len(sequence) != self._n_samples:
+          raise ValueError(
+              'Sequence {} does not have length n_samples={}'.format(
+                  sequence, self._n_samples))
+        rows.append(
+            [self._value_ids.get(value, missing_id) for value in sequence])
+      ids = np.array(rows, dtype=np.int64)
+    if not len(ids):
+      return sympy.Integer(0)
+
+    # Drop sequences containing a repeated value (not "without replacement"),
+    # or a value of zero probability.
+    sorted_ids = np.sort(ids, axis=1)
+    repeated = np.any(np.diff(sorted_ids, axis=1) == 0, axis=1)
+    numerators = self._numerators[ids]
+    possible = np.all(numerators > 0, axis=1) & ~repeated
+    numerators = numerators[possible]
+    if not len(numerators):
+      return sympy.Integer(0)
+
+    # Sequence probability is prod_i p_i / (1 - sum_{j < i} p_j). Use exact
+    # integer arithmetic; falling back to Python integers (object arrays) if
+    # this could overflow int64.
+    num_sequences, length = numerators.shape
+    if num_sequences * self._denominator**length >= 2**63:
+      numerators = numerators.astype(object)
+    denominators = self._denominator - (
+        np.cumsum(numerators, axis=1) - numerators)
+    sequence_numerators = np.prod(numerators, axis=1)
+    sequence_denominators = np.prod(denominators, axis=1)
+
+    # Sum numerators sharing a denominator, then combine the (few) distinct
+    # denominators as rationals.
+    unique_denominators, inverse = np.unique(
+        sequence_denominators, return_inverse=True)
+    numerator_sums = np.zeros(len(unique_denominators),
+                              dtype=sequence_numerators.dtype)
+    np.add.at(numerator_sums, inverse.reshape(-1), sequence_numerators)
+    return sum(
+        (sympy.Rational(int(numerator), int(denominator))
+         for numerator, denominator
+         in zip(numerator_sums, unique_denominators)),
+        sympy.Integer(0))
 
 
 class IdentityRandomVariable(RandomVariable):
@@ -333,6 +561,8 @@ class DiscreteRandomVariable(RandomVariable):
         self._inverse[value].add(key)
       else:
         self._inverse[value] = set([key])
+    self._inverse = {
+        value: frozenset(keys) for value, keys in six.iteritems(self._inverse)}
 
   def __call__(self, event):
     if isinstance(event, DiscreteEvent):
@@ -342,10 +572,9 @@ class DiscreteRandomVariable(RandomVariable):
 
   def inverse(self, event):
     if isinstance(event, DiscreteEvent):
-      set_ = set()
-      for value in event.values:
-        if value in self._inverse:
-          set_.update(self._inverse[value])
+      set_ = frozenset().union(*[
+          self._inverse[value]
+          for value in event.values if value in self._inverse])
       return DiscreteEvent(set_)
     else:
       raise ValueError('Unhandled event type {}'.format(type(event)))
@@ -388,18 +617,42 @@ class FiniteProductRandomVariable(RandomVariable):
           random_variable.inverse(sub_event)
           for random_variable, sub_event in zipped))
 
+    # The same (random variable, element) pairs recur across sequences, so
+    # memoize their inverse images.
+    inverse_cache = {}
+
+    def element_inverse(random_variable, element):
+      key = (id(random_variable), element)
+      if key not in inverse_cache:
+        inverse_cache[key] = random_variable.inverse(
+            DiscreteEvent({element})).values
+      return inverse_cache[key]
+
+    mapped = set()
+
+    # Specialization for `CountLevelSetEvent`; map the label table once per
+    # position, and then read the label ids of each sequence.
+    if isinstance(event, CountLevelSetEvent):
+      sequence_ids = event.sequence_ids()
+      assert sequence_ids.shape[1] == len(self._random_variables)
+      inverses = [
+          [element_inverse(random_variable, label) for label in event.labels]
+          for random_variable in self._random_variables]
+      for ids in sequence_ids.tolist():
+        mapped.update(itertools.product(*[
+            inverse[i] for inverse, i in zip(inverses, ids)]))
+      return SequenceEvent(mapped)
+
     # Try fallback of mapping each sequence separately.
     try:
       all_sequences = event.all_sequences()
     except AttributeError:
       raise ValueError('Unhandled event type {}'.format(type(event)))
 
-    mapped = set()
     for sequence in all_sequences:
       assert len(sequence) == len(self._random_variables)
-      zipped = list(zip(self._random_variables, sequence))
-      mapped_sequence = FiniteProductEvent(tuple(
-          random_variable.inverse(DiscreteEvent({element}))
-          for random_variable, element in zipped))
-      mapped.update(mapped_sequence.all_sequences())
+      mapped.update(itertools.product(*[
+          element_inverse(random_variable, element)
+          for random_variable, element
+          in zip(self._random_variables, sequence)]))
     return SequenceEvent(mapped)
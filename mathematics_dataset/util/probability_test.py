@@ -24,6 +24,30 @@ from mathematics_dataset.util import probability
 import sympy
 
 
+class _CountingProbabilitySpace(probability.DiscreteProbabilitySpace):
+  """Discrete probability space that counts calls to `probability`."""
+
+  def __init__(self, weights):
+    super(_CountingProbabilitySpace, self).__init__(weights)
+    self.num_calls = 0
+
+  def probability(self, event):
+    self.num_calls += 1
+    return super(_CountingProbabilitySpace, self).probability(event)
+
+
+class DiscreteEventTest(absltest.TestCase):
+
+  def testEqualityAndHash(self):
+    event_1 = probability.DiscreteEvent([1, 2, 2])
+    event_2 = probability.DiscreteEvent({2, 1})
+    self.assertIsInstance(event_1.values, frozenset)
+    self.assertEqual(event_1, event_2)
+    self.assertEqual(hash(event_1), hash(event_2))
+    self.assertNotEqual(event_1, probability.DiscreteEvent({1}))
+    self.assertLen({event_1, event_2}, 1)
+
+
 class FiniteProductEventTest(absltest.TestCase):
 
   def testAllSequences(self):
@@ -32,12 +56,18 @@ class FiniteProductEventTest(absltest.TestCase):
     all_sequences = [i for i in event.all_sequences()]
     self.assertEqual(all_sequences, [(1, 3), (2, 3)])
 
+  def testCardinality(self):
+    event = probability.FiniteProductEvent([probability.DiscreteEvent({1, 2}),
+                                            probability.DiscreteEvent({3}),
+                                            probability.DiscreteEvent({4, 5})])
+    self.assertEqual(event.cardinality, 4)
+
 
 class CountLevelSetEventTest(absltest.TestCase):
 
   def testAllSequences(self):
     event = probability.CountLevelSetEvent({'a': 2, 'b': 4, 'c': 1})
-    all_sequences = event.all_sequences()
+    all_sequences = list(event.all_sequences())
 
     # Number of sequences should be 7! / (4! * 2! * 1!) = 105.
     self.assertLen(all_sequences, 105)
@@ -46,6 +76,20 @@ class CountLevelSetEventTest(absltest.TestCase):
     # And check contains one correctly generated tuple.
     self.assertIn(('a', 'b', 'c', 'b', 'b', 'a', 'b'), all_sequences)
 
+  def testAllSequences_zeroCount(self):
+    event = probability.CountLevelSetEvent({'a': 0, 'b': 2, 'c': 1})
+    self.assertEqual(list(event.all_sequences()),
+                     [('b', 'b', 'c'), ('b', 'c', 'b'), ('c', 'b', 'b')])
+
+    event = probability.CountLevelSetEvent({'a': 0})
+    self.assertEqual(list(event.all_sequences()), [()])
+
+  def testSequenceIds(self):
+    event = probability.CountLevelSetEvent({'a': 1, 'b': 2})
+    self.assertEqual(event.labels, ('a', 'b'))
+    self.assertEqual(event.sequence_ids().tolist(),
+                     [[0, 1, 1], [1, 0, 1], [1, 1, 0]])
+
 
 class DiscreteProbabilitySpaceTest(absltest.TestCase):
 
@@ -88,6 +132,26 @@ class FiniteProductSpaceTest(absltest.TestCase):
     self.assertEqual(space.probability(event),
                      coeff * pow(p_a, 7) * pow(p_b, 2) * pow(p_c, 3))
 
+    # Values outside of the space have zero probability.
+    event = probability.CountLevelSetEvent({'a': 10, 'd': 2})
+    self.assertEqual(space.probability(event), 0)
+
+  def testProbability_memoizesSubSpaceProbabilities(self):
+    base_space = _CountingProbabilitySpace({'h': 1, 't': 2})
+    space = probability.FiniteProductSpace([base_space] * 3)
+
+    heads = probability.DiscreteEvent({'h'})
+    tails = probability.DiscreteEvent({'t'})
+    event = probability.FiniteProductEvent([heads, tails, heads])
+    self.assertEqual(space.probability(event), sympy.Rational(2, 27))
+    self.assertEqual(base_space.num_calls, 2)
+
+    # Repeated (and equal) events are answered from the cache.
+    event = probability.FiniteProductEvent(
+        [tails, probability.DiscreteEvent(['h']), tails])
+    self.assertEqual(space.probability(event), sympy.Rational(4, 27))
+    self.assertEqual(base_space.num_calls, 2)
+
 
 class SampleWithoutReplacementSpaceTest(absltest.TestCase):
 
@@ -113,6 +177,19 @@ class SampleWithoutReplacementSpaceTest(absltest.TestCase):
     self.assertEqual(p_1, 0)
     self.assertEqual(p_2, 0)
 
+  def testSequenceEvent(self):
+    space = probability.SampleWithoutReplacementSpace(
+        {'a': 1, 'b': 2, 'c': 3}, 2)
+    event = probability.SequenceEvent(
+        {('a', 'b'), ('b', 'a'), ('a', 'a'), ('a', 'd')})
+    # p(a, b) + p(b, a) = 1/6 * 2/5 + 2/6 * 1/4.
+    self.assertEqual(space.probability(event), sympy.Rational(3, 20))
+    self.assertEqual(space.probability(probability.SequenceEvent(set())), 0)
+
+    event = probability.SequenceEvent({('a', 'b'), ('a',)})
+    with self.assertRaisesRegex(ValueError, 'does not have length'):
+      space.probability(event)
+
 
 class DiscreteRandomVariableTest(absltest.TestCase):
 